@@ -7,14 +7,45 @@
 """
 
 
+from __future__ import annotations
+
+import itertools
 import json
 import os
+import re
 import shlex
-from typing import Callable, Dict, List
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import IO, Any, Callable, Deque, Dict, FrozenSet, Iterator, List, Optional
 
-from .shell import execute, execute_with_stdout, save_content
+from .expr import global_eval_path
+from .ninja import extension_name
+from .shell import execute, execute_with_pipe
 from .writeln import LogLevel, log_out
 
+try:
+    # optional, the faster json serializer
+    import orjson  # type: ignore[import-not-found, unused-ignore]
+    _HAS_ORJSON = True
+except ImportError:
+    _HAS_ORJSON = False
+
+_JSON_DECODER = json.JSONDecoder()
+
+_WHITESPACE = re.compile(r'\s*')
+
+# the characters after an item of the json array
+_ARRAY_SEPARATORS = frozenset(',] \t\r\n')
+
+# the `-fno-xxxx` arguments that are kept in the compdb
+_COMPDB_ALLOW_FEATURES = frozenset({
+    '-fno-exceptions',
+    '-fno-rtti',
+})
+
+# command argument, the spaces are allowed in the `""`
+_ARGUMENT_PATTERN = re.compile(r'(?:"[^"]*"|[^\s"])+')
+
 
 def build() -> Callable[[Dict[str, str], Dict[str, str]], None]:
     """
@@ -41,75 +72,300 @@ def compdb(compdb_path: str = 'compile_commands.json') -> Callable[[Dict[str, st
     Run command `ninja -t compdb`, and save it to `compdb`
     """
     def inner_fn(opts: Dict[str, str], args: Dict[str, str]) -> None:
-        compdb = execute_with_stdout(['ninja', '-t', 'compdb'])
+        path_val = global_eval_path(compdb_path)
+        stamp_path = global_eval_path('$target/.compdb.stamp')
+
+        # skip it if `build.ninja` was not changed since the last run
+        stamp = _compdb_stamp(path_val)
+        if stamp is not None and os.path.exists(path_val) and _read_stamp(stamp_path) == stamp:
+            log_out(LogLevel.INFO, f'`{compdb_path}` is up-to-date.')
+            return
+
+        # the old stamp is invalid until the new database was saved
+        if os.path.exists(stamp_path):
+            os.remove(stamp_path)
+
+        # stream the json from `ninja` into a temporary file, replace the old one if it succeeded
+        dir_name, base_name = os.path.split(path_val)
+        temp_path = os.path.join(dir_name, f'.tmp.{base_name}')
+        try:
+            with execute_with_pipe(['ninja', '-t', 'compdb']) as compdb:
+                with open(temp_path, 'w', encoding='utf-8', newline='\n') as f:
+                    _simplify_compdb(compdb, f)
+            os.replace(temp_path, path_val)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
 
-        # write json
-        json_str = _simplify_compdb(compdb)
-        save_content(compdb_path, json_str)
+        # record this run
+        if stamp is not None:
+            os.makedirs(os.path.dirname(stamp_path), exist_ok=True)
+            with open(stamp_path, 'w', encoding='utf-8') as f:
+                f.write(stamp)
 
         log_out(LogLevel.INFO, f'Save to `{compdb_path}` completed.')
 
     return inner_fn
 
 
+def _compdb_stamp(compdb_path: str) -> Optional[str]:
+    """
+    Get the stamp of the compiled database, it changes when `build.ninja` changes
+
+    Return `None` if there is no `build.ninja`.
+    """
+    try:
+        manifest_mtime = os.stat('build.ninja').st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    return f'{manifest_mtime} {os.path.abspath(compdb_path)}'
+
+
+def _read_stamp(stamp_path: str) -> Optional[str]:
+    """
+    Read the stamp file, return `None` if it does not exist
+    """
+    try:
+        with open(stamp_path, 'r', encoding='utf-8') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
 def _simplify_compdb(
-    json_str: str,
-    outs: List[str] = ['.o', '.obj'],
-    exts: List[str] = ['.c', '.h', '.s', '.asm', '.cc', '.hpp', '.cpp', '.ixx', '.cxx'],
-) -> str:
+    json_in: IO[str],
+    json_out: IO[str],
+    outs: FrozenSet[str] = frozenset({'.o', '.obj'}),
+    exts: FrozenSet[str] = frozenset({'.c', '.h', '.s', '.asm', '.cc', '.hpp', '.cpp', '.ixx', '.cxx'}),
+) -> None:
     """
     Simpilify the clangd compiled database
+
+    The entries are read from `json_in` and written to `json_out` one by one,
+    so the whole database is never loaded into the memory.
+    """
+    separator = '\n'
+    json_items = iter(_JsonArrayReader(json_in))
+
+    json_out.write('[')
+    for json_trim in _simplify_compdb_chunks(json_items, outs, exts):
+        for json_content in json_trim:
+            json_out.write(separator)
+            json_out.write(json_content)
+            separator = ',\n'
+
+    json_out.write('\n]\n')
+
+
+def _simplify_compdb_chunks(
+    json_items: Iterator[Dict[str, str]],
+    outs: FrozenSet[str],
+    exts: FrozenSet[str],
+    chunk_size: int = 2048,
+) -> Iterator[List[str]]:
+    """
+    Simpilify the entries chunk by chunk, and keep the order of the entries
+
+    If there are more than one chunk, they are dispatched to a process pool.
+    """
+    chunks = iter(lambda: list(itertools.islice(json_items, chunk_size)), [])
+
+    # the small database does not pay for the process pool
+    first_chunk = next(chunks, [])
+    if len(first_chunk) < chunk_size:
+        yield _simplify_compdb_chunk(first_chunk, outs, exts)
+        return
+
+    max_workers = os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers) as pool:
+        pending: Deque[Future[List[str]]] = deque()
+
+        for chunk in itertools.chain([first_chunk], chunks):
+            pending.append(pool.submit(_simplify_compdb_chunk, chunk, outs, exts))
+
+            # limit the chunks in flight, so the memory usage is bounded
+            if len(pending) > 2 * max_workers:
+                yield pending.popleft().result()
+
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+
+def _simplify_compdb_chunk(
+    json_items: List[Dict[str, str]],
+    outs: FrozenSet[str],
+    exts: FrozenSet[str],
+) -> List[str]:
+    """
+    Simpilify a chunk of the entries and serialize them, the ignored entries are removed
     """
-    json_obj = json.loads(json_str)
     json_trim = []
-    for json_item in json_obj:
-        out_name = json_item['output']
-        out_ext = os.path.splitext(os.path.basename(out_name))[1]
-        file_name = json_item['file']
-        file_ext = os.path.splitext(os.path.basename(file_name))[1]
-        if file_ext in exts and out_ext in outs:
-            json_content = {
-                'file': os.path.normpath(file_name),
-                'output': os.path.normpath(json_item['output']),
-                'directory': json_item['directory'],
-                'command': _compdb_filer_command(json_item['command'])
-            }
-            json_trim.append(json_content)
-
-    # return the json
-    return json.dumps(json_trim, indent=2, separators=(',', ': '))
+    for json_item in json_items:
+        json_content = _simplify_compdb_item(json_item, outs, exts)
+        if json_content is not None:
+            json_trim.append(_json_dumps(json_content))
+
+    return json_trim
+
+
+def _json_dumps(obj: Any) -> str:
+    """
+    Serialize the object to a compact json string, use `orjson` if it was installed
+
+    Both of them write the non-ASCII characters as they are, so the output is the same.
+    """
+    if _HAS_ORJSON:
+        content: str = orjson.dumps(obj).decode('utf-8')
+        return content
+    else:
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+
+
+def _simplify_compdb_item(
+    json_item: Dict[str, str],
+    outs: FrozenSet[str],
+    exts: FrozenSet[str],
+) -> Optional[Dict[str, str]]:
+    """
+    Simpilify an entry of the compiled database, return `None` if it was ignored
+    """
+    file_name = json_item['file']
+    if extension_name(file_name) not in exts:
+        return None
+
+    out_name = json_item['output']
+    if extension_name(out_name) not in outs:
+        return None
+
+    return {
+        'file': os.path.normpath(file_name),
+        'output': os.path.normpath(out_name),
+        'directory': json_item['directory'],
+        'command': _compdb_filer_command(json_item['command'])
+    }
+
+
+class _JsonArrayReader:
+    """
+    (private) Parse the items of a json array from a text stream one by one
+    """
+    stream: IO[str]
+    chunk_size: int
+    buffer: str
+    pos: int
+    eof: bool
+
+    def __init__(self, stream: IO[str], chunk_size: int = 1 << 16) -> None:
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def __iter__(self) -> Iterator[Any]:
+        self._expect('[')
+
+        # empty array
+        if self._peek() == ']':
+            self.pos += 1
+            return
+
+        while True:
+            yield self._decode()
+
+            if self._expect(',]') == ']':
+                return
+
+    def _fill(self) -> bool:
+        """
+        Read the next chunk, drop the parsed content, return false at the end of stream
+        """
+        chunk = self.stream.read(self.chunk_size)
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        self.eof = len(chunk) == 0
+        return not self.eof
+
+    def _peek(self) -> str:
+        """
+        Skip the spaces and return the next character, or `''` at the end of stream
+        """
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()  # type: ignore[union-attr]
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+
+            if not self._fill():
+                return ''
+
+    def _expect(self, chars: str) -> str:
+        """
+        Consume one of the `chars` and return it
+        """
+        ch = self._peek()
+        if len(ch) == 0 or ch not in chars:
+            raise json.JSONDecodeError(f'Expecting one of `{chars}`', self.buffer, self.pos)
+
+        self.pos += 1
+        return ch
+
+    def _decode(self) -> Any:
+        """
+        Decode the next json value
+        """
+        self._peek()
+        while True:
+            try:
+                obj, end = _JSON_DECODER.raw_decode(self.buffer, self.pos)
+                # the value may be truncated at the end of the buffer, e.g. `2.` of `2.5`,
+                # so it must be followed by a separator of the array
+                if self.eof or (end < len(self.buffer) and self.buffer[end] in _ARRAY_SEPARATORS):
+                    self.pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+
+            self._fill()
 
 
 def _compdb_filer_command(cmd: str) -> str:
     """
     Return the command that can be supported clangd
     """
-    args = shlex.split(cmd, posix=False)
-    used_args = filter(lambda s: not _compdb_filted_argument(s), args)
-    new_cmd = ' '.join(_compdb_map_argument(arg) for arg in used_args)
-    return new_cmd
+    # trip the gcc `-fno-xxxx` argument
+    used_args = [
+        arg for arg in _compdb_split_command(cmd)
+        if not arg.startswith('-fno-') or arg in _COMPDB_ALLOW_FEATURES
+    ]
+
+    # map the command argument with `""`
+    return ' '.join(
+        f'"{arg}"' if len(arg) == 0 or (' ' in arg and '"' not in arg) else arg
+        for arg in used_args
+    )
 
 
-def _compdb_map_argument(arg: str) -> str:
+def _compdb_split_command(cmd: str) -> List[str]:
     """
-    Map the command argument with `""`
+    Split the command into the arguments, and remove the `""` around an argument
+
+    The arguments are kept as they are if the command has escaped or unbalanced quotes.
     """
-    if arg.find(' ') != -1:
-        return f'"{arg}"'
-    else:
-        return arg
+    if '\\"' in cmd or cmd.count('"') % 2 != 0:
+        # leave them to `shlex`, the tokens may be split at an escaped quote,
+        # so unquoting them would break the quotes of the joined command
+        return shlex.split(cmd, posix=False)
+
+    return [_compdb_unquote_argument(arg) for arg in _ARGUMENT_PATTERN.findall(cmd)]
 
 
-def _compdb_filted_argument(arg: str) -> bool:
+def _compdb_unquote_argument(arg: str) -> str:
     """
-    Return true if this argument need be ignored
+    Remove the `""` if the whole argument was quoted, e.g. `"a b"` -> `a b`
     """
-    allow_features = [
-        '-fno-exceptions',
-        '-fno-rtti',
-    ]
-    if arg.startswith('-fno-') and arg not in allow_features:
-        # trip the gcc `-fno-xxxx` argument
-        return True
+    if len(arg) >= 2 and arg[0] == '"' and arg[-1] == '"' and arg.count('"') == 2:
+        return arg[1:-1]
     else:
-        return False
+        return arg
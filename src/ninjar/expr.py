@@ -9,11 +9,15 @@ This module provides the global variable
 """
 
 
+from __future__ import annotations
+
 import os
+import re
 import sys
+from collections import ChainMap
 from datetime import datetime
-from string import Template
-from typing import Dict
+from functools import lru_cache
+from typing import Callable, Dict, Mapping, Optional, Tuple
 
 
 class ExprEvalException(RuntimeError):
@@ -25,6 +29,39 @@ class ExprEvalException(RuntimeError):
         super().__init__(*args)
 
 
+# variable reference: `$$`, `$name`, `${name}` or an invalid `$`
+_VAR_PATTERN = re.compile(r'\$(?:(\$)|([_a-zA-Z][_a-zA-Z0-9]*)|\{([_a-zA-Z][_a-zA-Z0-9]*)\}|)')
+
+
+class _LazyVariables(Dict[str, str]):
+    """
+    (private) Variable table, the lazy variables are evaluated at the first access
+    """
+    lazy_fns: Dict[str, Callable[[], str]]
+
+    def __init__(self, values: Dict[str, str], lazy_fns: Dict[str, Callable[[], str]]) -> None:
+        super().__init__(values)
+        self.lazy_fns = lazy_fns
+
+    def __missing__(self, key: str) -> str:
+        # the function is kept, so the key never disappears while another thread evaluates it
+        lazy_fn = self.lazy_fns.get(key)
+        if lazy_fn is None:
+            raise KeyError(key)
+
+        return self.setdefault(key, lazy_fn())
+
+    def __contains__(self, key: object) -> bool:
+        return super().__contains__(key) or key in self.lazy_fns
+
+    def copy(self) -> Dict[str, str]:
+        """
+        Copy the table, all lazy variables are evaluated
+        """
+        lazy_values = {key: self[key] for key in list(self.lazy_fns)}
+        return {**self, **lazy_values}
+
+
 # basic variables
 global_variables: Dict[str, str]
 
@@ -37,12 +74,21 @@ def get_global_variables() -> Dict[str, str]:
     return global_variables.copy()
 
 
+def is_global_variable(name: str) -> bool:
+    """
+    Check the variable was defined, the lazy variables are not evaluated
+    """
+    global global_variables
+    return name in global_variables
+
+
 def update_global_variables(values: Dict[str, str]) -> None:
     """
     get the basic variable
     """
     global global_variables
-    global_variables.update(values)
+    global_variables.update((sys.intern(key), value) for key, value in values.items())
+    cached_global_eval_expr.cache_clear()
 
 
 def setup_global_variable() -> None:
@@ -56,72 +102,139 @@ def setup_global_variable() -> None:
     now = datetime.now()
 
     # pre-define variables
-    global_variables = {
+    global_variables = _LazyVariables({
         'root': base_dir(),
         'build': 'target/build',
         'package': 'target/pkgs',
         'tbgen_out': 'target/tbgen',
         'target': 'target',
         'option_hash': 'unknown',
-        'date': str(datetime.date(now)),
-        'time': str(datetime.time(now)),
-        'timestamp': str(datetime.timestamp(now)),
         'self_script_host': os.path.basename(sys.executable),
         'self_script_name': sys.argv[0],
-    }
+    }, {
+        # formatted only if they are used
+        'date': lambda: str(datetime.date(now)),
+        'time': lambda: str(datetime.time(now)),
+        'timestamp': lambda: str(datetime.timestamp(now)),
+    })
 
     # add the enviroment variables
-    env_var_table = dict(os.environ)
-    for (env_name, env_val) in env_var_table.items():
+    env_var_table = {
+        sys.intern(f'env_{env_name}'.lower()): env_val for env_name, env_val in os.environ.items()
+    }
+
+    # the names are case-insensitive, and must not hide the pre-define variables
+    redefined = env_var_table.keys() & global_variables.keys()
+    if len(redefined) > 0 or len(env_var_table) != len(os.environ):
+        buildin_name = min(redefined) if len(redefined) > 0 else _duplicated_env_name()
+        raise RuntimeError(f'Logic error: enviroment variable `{buildin_name}` was re-defined')
+
+    global_variables.update(env_var_table)
+    cached_global_eval_expr.cache_clear()
+
+
+def _duplicated_env_name() -> str:
+    """
+    (private) Get the enviroment variable name that is duplicated after lower-casing
+    """
+    env_names = set()
+    for env_name in os.environ:
         buildin_name = f'env_{env_name}'.lower()
-        if buildin_name in global_variables:
-            raise RuntimeError(f'Logic error: enviroment variable `{buildin_name}` was re-defined')
-        else:
-            global_variables.update({buildin_name: env_val})
+        if buildin_name in env_names:
+            return buildin_name
+
+        env_names.add(buildin_name)
 
+    return ''
 
+
+@lru_cache(maxsize=1)
 def base_dir() -> str:
     return os.path.abspath('.')
 
 
-def global_eval_path(path: str, addition_dict: Dict[str, str] = {}) -> str:
-    global global_variables
-    var_dict = global_variables.copy()
-    var_dict.update(addition_dict)
-    return eval_path(path, var_dict)
+def global_eval_path(path: str, addition_dict: Optional[Dict[str, str]] = None) -> str:
+    return eval_path(path, _chain_variables(addition_dict))
+
 
+def global_eval_expr(path: str, addition_dict: Optional[Dict[str, str]] = None) -> str:
+    return eval_expr(path, _chain_variables(addition_dict))
 
-def global_eval_expr(path: str, addition_dict: Dict[str, str] = {}) -> str:
+
+@lru_cache(maxsize=4096)
+def cached_global_eval_expr(expr: str) -> str:
+    """
+    Same as `global_eval_expr`, the results are cached until the global variables are changed
+    """
+    return eval_expr(expr, global_variables)
+
+
+def _chain_variables(addition_dict: Optional[Dict[str, str]]) -> Mapping[str, str]:
+    """
+    (private) Get the global variables overlaid by `addition_dict`, without copying them
+    """
     global global_variables
-    var_dict = global_variables.copy()
-    var_dict.update(addition_dict)
-    return eval_expr(path, var_dict)
+    if not addition_dict:
+        return global_variables
+
+    return ChainMap(addition_dict, global_variables)
 
 
-def eval_path(path: str, vars: Dict[str, str]) -> str:
+def eval_path(path: str, vars: Mapping[str, str]) -> str:
     expr = eval_expr(path, vars)
     return os.path.normpath(expr)
 
 
-def eval_expr(expr: str, vars: Dict[str, str]) -> str:
-    max_step = 16
-    old_expr = expr
+def eval_expr(expr: str, vars: Mapping[str, str]) -> str:
+    # nothing to substitute
+    if '$' not in expr:
+        return expr
+
+    return _expand_expr(expr, expr, vars, (), {})
+
+
+def _expand_expr(
+    expr: str,
+    origin: str,
+    vars: Mapping[str, str],
+    depth_list: Tuple[str, ...],
+    resolved: Dict[str, str],
+) -> str:
+    """
+    (private) Substitute the variables in `expr` recursively
+
+    `depth_list` records the variables being expanded, to detect the cycle reference,
+    `resolved` caches the expanded variables, so each variable is expanded once per call
+    """
+    def replace_fn(match: re.Match[str]) -> str:
+        escaped, named, braced = match.groups()
+
+        # `$$` is the escape character
+        if escaped is not None:
+            return '$'
+
+        var_name = named if named is not None else braced
+        if var_name is None:
+            raise ExprEvalException(f'invalid placeholder `$` in `{origin}`')
+
+        # this variable was expanded
+        if var_name in resolved:
+            return resolved[var_name]
 
-    # to keep the escape character
-    # 好笨蛋 QAQ
-    expr = expr.replace('$$', '@=@')
+        # check the recursion depth
+        if var_name in depth_list:
+            hint_msg = ' -> '.join(depth_list + (var_name,))
+            raise ExprEvalException(f'cannot eval express: `{origin}`, cycle reference: {hint_msg}')
 
-    try:
-        while expr.find('$') != -1 and max_step > 0:
-            patt = Template(expr)
-            expr = patt.substitute(vars)
-            max_step -= 1
-    except KeyError as e:
-        raise ExprEvalException(f'variable `{e.args[0]}` was not found, it was used in `{old_expr}`')
+        if var_name not in vars:
+            raise ExprEvalException(f'variable `{var_name}` was not found, it was used in `{origin}`')
 
-    if max_step == 0:
-        raise ExprEvalException(f'cannot eval express: `{old_expr}`, max eval step')
+        var_value = vars[var_name]
+        if '$' not in var_value:
+            return var_value
 
-    expr = expr.replace('@=@', '$')
+        var_value = _expand_expr(var_value, origin, vars, depth_list + (var_name,), resolved)
+        resolved[var_name] = var_value
+        return var_value
 
-    return expr
+    return _VAR_PATTERN.sub(replace_fn, expr)
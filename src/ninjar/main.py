@@ -9,16 +9,29 @@ This module provides a command invoker based `inspect` module.
 """
 
 
+from __future__ import annotations
+
 import argparse
 import hashlib
+import importlib
 import inspect
 from dataclasses import dataclass
 from enum import Enum
-from functools import wraps
 from types import ModuleType
-from typing import Any, Callable, Dict, List, NoReturn, Tuple, TypeAlias, Union
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NoReturn,
+    Optional,
+    Set,
+    Tuple,
+    TypeAlias,
+    Union,
+)
 
-from . import cmds as ninja_tool
 from . import expr, shell, writeln
 from .ninja import QueryTypeError
 from .writeln import LogLevel, log_out
@@ -63,14 +76,30 @@ class ActionArgumentType(Enum):
     APPEND_LIST = '+'
 
 
-@dataclass
+# `add_argument` keywords for each argument type
+# note: argparse copies the default list before extending it, so it can be shared
+_ADD_ARGUMENT_KWARGS: Dict[ActionArgumentType, Dict[str, Any]] = {
+    # append to the list, like --arg va1 val2 ...
+    ActionArgumentType.APPEND_LIST: {'type': str, 'default': [], 'action': 'extend', 'nargs': '+'},
+    # store true
+    ActionArgumentType.OPTION: {'default': False, 'action': 'store_true'},
+    # just a value
+    ActionArgumentType.VALUE: {'type': str, 'default': ''},
+}
+
+
+@dataclass(slots=True)
 class ActionArgument:
     typ: ActionArgumentType
     name: str
     descript: str
+    # the argparse option, e.g. `--action-arg-name`
+    opt_name: str
+    # the attribute name in the parsed arguments, e.g. `action_arg_name`
+    attr_name: str
 
 
-@dataclass
+@dataclass(slots=True)
 class Action:
     name: str
     descript: str
@@ -80,7 +109,7 @@ class Action:
     eval_fn: Callable[[Dict[str, str], Dict[str, str]], None]
 
 
-@dataclass
+@dataclass(slots=True)
 class UserOption:
     name: str
     value: str
@@ -88,31 +117,56 @@ class UserOption:
     filter_fn: Callable[[str], bool]
 
 
-def variables() -> Callable[[UserVarFunction], UserVarFunction]:
+def _always_true(x: str) -> bool:
     """
-    Specify variables
+    (private) The default option filter, accept all values
+    """
+    return True
+
+
+# filter of the `release` option
+_RELEASE_FILTER: Callable[[str], bool] = frozenset({'0', '1'}).__contains__
+
+
+class _VariablesDict(Dict[str, str]):
+    """
+    (private) The variables defined by `@variables()`
     """
 
-    def var_inner(vars_lazy_fn: UserVarFunction) -> UserVarFunction:
-        result = vars_lazy_fn()
 
-        def build_script_variables() -> Dict[str, str]:
-            return result
+class _OptionsDict(Dict[str, UserOption]):
+    """
+    (private) The options defined by `@options()`
+    """
 
-        return build_script_variables
+
+@dataclass
+class _ModuleObjects:
+    """
+    (private) The objects defined in the build script module
+    """
+    actions: List[Action]
+    options: List[_OptionsDict]
+    variables: List[_VariablesDict]
+
+
+def variables() -> Callable[[UserVarFunction], _VariablesDict]:
+    """
+    Specify variables
+    """
+
+    def var_inner(vars_lazy_fn: UserVarFunction) -> _VariablesDict:
+        return _VariablesDict(vars_lazy_fn())
 
     return var_inner
 
 
-def options() -> Callable[[UserOptFunction], Callable[[], Dict[str, UserOption]]]:
+def options() -> Callable[[UserOptFunction], _OptionsDict]:
     """
     Specify options
     """
-    def default_filter_fn(x: Any) -> bool:
-        return True
-
-    def var_inner(vars_lazy_fn: UserOptFunction) -> Callable[[], Dict[str, UserOption]]:
-        result = {}
+    def var_inner(vars_lazy_fn: UserOptFunction) -> _OptionsDict:
+        result = _OptionsDict()
         var_value = vars_lazy_fn()
 
         for key, value in var_value.items():
@@ -120,7 +174,7 @@ def options() -> Callable[[UserOptFunction], Callable[[], Dict[str, UserOption]]
                 if len(value) == 2:
                     if isinstance(value[1], str):
                         # for `(tuple)`, it's (default_value, description)
-                        obj = UserOption(key, str(value[0]), value[1], default_filter_fn)
+                        obj = UserOption(key, str(value[0]), value[1], _always_true)
                     elif inspect.isfunction(value[1]):
                         # for `(tuple)`, it's (default_value, filter_function)
                         obj = UserOption(key, str(value[0]), 'No description', value[1])
@@ -133,42 +187,39 @@ def options() -> Callable[[UserOptFunction], Callable[[], Dict[str, UserOption]]
                     raise RuntimeError(f'Variable item `{key}` has incorrent tuple value `{value}`')
             else:
                 # for `str`, it's default_value
-                obj = UserOption(key, str(value), 'No description', default_filter_fn)
-
-            result.update({key: obj})
+                obj = UserOption(key, str(value), 'No description', _always_true)
 
-        def build_script_user_options() -> Dict[str, UserOption]:
-            return result
+            result[key] = obj
 
-        return build_script_user_options
+        return result
 
     return var_inner
 
 
 def action(
-    deps: Union[List[str], str] = [],
-    arg_list: List[Union[str, Tuple[str, str]]] = [],
+    deps: Union[List[str], str, None] = None,
+    arg_list: Optional[List[Union[str, Tuple[str, str]]]] = None,
     default: bool = False
 ) -> Callable[[ActionFunction], Action]:
     """
     Specify a step/script for the build script
     """
     def deps_inner(func: ActionFunction) -> Action:
-        @wraps(func)
-        def wrapped(arg1: Dict[str, str], arg2: Dict[str, str]) -> None:
-            return func(arg1, arg2)
-
-        if isinstance(deps, list):
-            deps_list = deps.copy()
-        else:
+        if deps is None:
+            deps_list = []
+        elif isinstance(deps, str):
             deps_list = [deps]
+        else:
+            deps_list = deps
 
         func_name = func.__name__
         func_docs = inspect.getdoc(func)
         func_descript = 'No description' if func_docs is None else func_docs
 
+        arg_items = [] if arg_list is None else arg_list
+
         func_args = []
-        for item in arg_list:
+        for item in arg_items:
             if isinstance(item, str):
                 arg_name = item
                 arg_descript = 'No description'
@@ -187,14 +238,30 @@ def action(
                 arg_typ = ActionArgumentType.VALUE
                 arg_actual_name = arg_name
 
+            # the argument names used by argparse
+            attr_name = f'{func_name}-{arg_actual_name}'.replace('-', '_')
+            opt_name = '--' + attr_name.replace('_', '-')
+
             # add to the argument list
-            func_args.append(ActionArgument(arg_typ, arg_actual_name, arg_descript))
+            func_args.append(ActionArgument(arg_typ, arg_actual_name, arg_descript, opt_name, attr_name))
 
-        return Action(func_name, func_descript, deps_list, default, func_args, wrapped)
+        return Action(func_name, func_descript, deps_list, default, func_args, func)
 
     return deps_inner
 
 
+def _ninja_tool_action(tool: str) -> ActionFunction:
+    """
+    (private) Get the action `cmds.<tool>()`, the `cmds` module is imported at the first run
+    """
+    def inner_fn(opts: Dict[str, str], args: Dict[str, str]) -> None:
+        ninja_tool = importlib.import_module('.cmds', __package__)
+        action_fn: ActionFunction = getattr(ninja_tool, tool)()
+        action_fn(opts, args)
+
+    return inner_fn
+
+
 class BuildScript:
     """
     Build script helper
@@ -215,11 +282,36 @@ class BuildScript:
         self.variables = {}
 
         # load objects
-        objs = {}
-        for obj_key, obj_val in inspect.getmembers(self_module):
-            objs.update({obj_key: obj_val})
+        objs = BuildScript._load_objects(self_module)
 
         try:
+            # release?
+            self.options['release'] = UserOption('release',
+                                                 str(0),
+                                                 'Use the release build?',
+                                                 _RELEASE_FILTER)
+            # add default action
+            self.actions['build'] = Action('build',
+                                           'Run `ninja` command',
+                                           ['ninja'],
+                                           False,
+                                           [],
+                                           _ninja_tool_action('build'))
+
+            self.actions['clean'] = Action('clean',
+                                           'Run `ninja -t clean` command',
+                                           ['ninja'],
+                                           False,
+                                           [],
+                                           _ninja_tool_action('clean'))
+
+            self.actions['compdb'] = Action('compdb',
+                                            'Run `ninja -t compdb > compiler_commands.json` command',
+                                            ['ninja'],
+                                            False,
+                                            [],
+                                            _ninja_tool_action('compdb'))
+
             # get the __doc__ from main module
             descript = inspect.getdoc(self_module)
             descript_str = 'Build script' if descript is None else descript
@@ -228,47 +320,29 @@ class BuildScript:
             parser = argparse.ArgumentParser(
                 description=descript_str,
                 formatter_class=argparse.RawTextHelpFormatter,
+                add_help=False,
             )
 
             # add default options
             BuildScript._add_default_arguments(parser)
 
-            # add action arguments
-            self._add_action_arguments(objs, parser)
+            # add action arguments, only for the actions that will be run
+            required_actions = self._required_actions(objs, parser)
+            self._add_action_arguments(required_actions, parser)
 
-            # parse the arguments
-            self.args = parser.parse_args()
+            # parse the arguments, the arguments of the other actions are still accepted,
+            # and the help is printed even if there are unknown arguments
+            self.args, unknown_args = parser.parse_known_args()
+            if len(unknown_args) > 0 and not self.args.help:
+                required_names = {act.name for act in required_actions}
+                other_actions = [act for act in objs.actions if act.name not in required_names]
+                self._add_action_arguments(other_actions, parser)
+                self.args = parser.parse_args()
 
-            # release?
-            self.options.update({
-                'release':  UserOption('release',
-                                       str(0),
-                                       'Use the release build?',
-                                       lambda s: s in ['1', '0'])})
-            # add default action
-            self.actions.update({
-                'build': Action('build',
-                                'Run `ninja` command',
-                                ['ninja'],
-                                False,
-                                [],
-                                ninja_tool.build())})
-
-            self.actions.update({
-                'clean': Action('clean',
-                                'Run `ninja -t clean` command',
-                                ['ninja'],
-                                False,
-                                [],
-                                ninja_tool.clean())})
-
-            self.actions.update({
-                'compdb': Action('compdb',
-                                'Run `ninja -t compdb > compiler_commands.json` command',
-                                 ['ninja'],
-                                 False,
-                                 [],
-                                 ninja_tool.compdb())})
+            # help?
+            if self.args.help:
+                parser.print_help()
+                quit(0)
 
             # add actions
             self._add_actions(objs)
@@ -348,16 +422,14 @@ class BuildScript:
         options_val = BuildScript._parse_options(self.options, self.args.option)
 
         # generate the options values
-        options_table = {}
-        for opt_name, opt_val in self.options.items():
-            options_table.update({opt_name: opt_val.value})
+        options_table = {name: opt.value for name, opt in self.options.items()}
 
         # update the options table
         options_table.update(options_val)
 
         # update global variables
-        for var_name, var_value in self.variables.items():
-            if var_name in expr.get_global_variables():
+        for var_name in self.variables:
+            if expr.is_global_variable(var_name):
                 raise BuildScriptException(f'Variable `{var_name}` was redefined')
 
         expr.update_global_variables(self.variables)
@@ -373,60 +445,72 @@ class BuildScript:
         """
         Run actions
         """
-        track_list: List[str] = []
+        track_list: Set[str] = set()
 
         for action in actions:
             if action not in self.actions:
                 raise BuildScriptException(f'Cannot find action `{action}`')
 
-            self._run_single_action(action, options, track_list, [])
+            self._run_single_action(action, options, track_list)
 
-    def _run_single_action(
-        self,
-        action: str,
-        user_options: Dict[str, str],
-        track_list: List[str], depth_list: List[str]
-    ) -> None:
+    def _run_single_action(self, action: str, user_options: Dict[str, str], track_list: Set[str]) -> None:
         """
-        Run actions
+        Run an action after its dependences
+
+        The dependences are walked in depth-first order with an explicit stack,
+        each action runs as soon as all of its dependences were run.
         """
-        if action in track_list:
-            return
+        # the running dependences, and the iterators of their dependences
+        depth_list: List[str] = []
+        depth_set: Set[str] = set()
+        deps_stack: List[Iterator[str]] = [iter([action])]
+
+        while len(deps_stack) > 0:
+            act_name = next(deps_stack[-1], None)
+
+            # all dependences were run, run this action
+            if act_name is None:
+                deps_stack.pop()
+                if len(depth_list) > 0:
+                    act = self.actions[depth_list.pop()]
+                    depth_set.remove(act.name)
+                    self._eval_action(act, user_options)
+                    track_list.add(act.name)
+                continue
 
-        # check the action existing
-        if action not in self.actions:
-            depth_list.reverse()
-            hint_msg = ' -> '.join(depth_list)
-            raise BuildScriptException(f'action {action} was not found, deps: {hint_msg}')
+            if act_name in track_list:
+                continue
 
-        act = self.actions[action]
+            # check the action existing
+            if act_name not in self.actions:
+                hint_msg = ' -> '.join(reversed(depth_list))
+                raise BuildScriptException(f'action {act_name} was not found, deps: {hint_msg}')
 
-        # check the recursion depth
-        if act.name in depth_list:
-            depth_list.reverse()
-            hint_msg = ' -> '.join(depth_list)
-            raise BuildScriptException(f'cycle reference: {act.name} -> {hint_msg}')
+            act = self.actions[act_name]
 
-        # record this call
-        depth_list.append(act.name)
+            # check the recursion depth
+            if act.name in depth_set:
+                hint_msg = ' -> '.join(reversed(depth_list))
+                raise BuildScriptException(f'cycle reference: {act.name} -> {hint_msg}')
 
-        # run the dependences
-        for act_name in act.deps:
-            self._run_single_action(act_name, user_options, track_list, depth_list.copy())
+            # record this call
+            depth_list.append(act.name)
+            depth_set.add(act.name)
+            deps_stack.append(iter(act.deps))
 
+    def _eval_action(self, act: Action, user_options: Dict[str, str]) -> None:
+        """
+        Run a single action without its dependences
+        """
         # generate the argument table
         arg_table = {}
 
         for add_args in act.additional_args:
-            arg_name = f'{act.name}-{add_args.name}'.replace('-', '_')
-            str_value = str(inspect.getattr_static(self.args, arg_name, ''))
-
-            arg_table.update({add_args.name: str_value})
+            arg_table[add_args.name] = str(getattr(self.args, add_args.attr_name, ''))
 
         # run this
-        log_out(LogLevel.MESSAGE, f'> run {action}')
+        log_out(LogLevel.MESSAGE, f'> run {act.name}')
         act.eval_fn(user_options, arg_table)
-        track_list.append(action)
 
     def _print_list(self) -> None:
         """
@@ -447,83 +531,109 @@ class BuildScript:
         if len(self.options) == 0:
             log_out(LogLevel.INFO, '- (no option was found)')
 
-    def _add_actions(self, objs: Dict[str, Any]) -> None:
+    def _add_actions(self, objs: _ModuleObjects) -> None:
         """
         Add actions into the list
         """
-        for k, obj in objs.items():
-            if not isinstance(obj, Action):
-                continue
-
+        for obj in objs.actions:
             if obj.name in self.actions:
                 raise BuildScriptException(f'Action `{obj.name}` was existed')
 
-            self.actions.update({obj.name: obj})
+            self.actions[obj.name] = obj
 
-    def _add_options(self, objs: Dict[str, Any]) -> None:
+    def _add_options(self, objs: _ModuleObjects) -> None:
         """
         Add custom-defined options
         """
-        for k, obj in objs.items():
-            if not inspect.isfunction(obj):
-                continue
+        for obj in objs.options:
+            self.options.update(obj)
 
-            if obj.__name__ != 'build_script_user_options':
-                continue
+    def _add_variables(self, objs: _ModuleObjects) -> None:
+        """
+        Add custom variables to global
+        """
+        for obj in objs.variables:
+            self.variables.update(obj)
+
+    def _add_action_arguments(self, actions: List[Action], parser: argparse.ArgumentParser) -> None:
+        """
+        Add argument for actions
+        """
+        for obj in actions:
+            p = parser.add_argument_group(title=f'{obj.name} options')
 
-            self.options.update(obj())
+            for arg in obj.additional_args:
+                if arg.typ not in _ADD_ARGUMENT_KWARGS:
+                    raise RuntimeWarning(f'Unknown type `{arg.typ}` for argument `{arg.name}`')
+
+                p.add_argument(arg.opt_name, help=arg.descript, **_ADD_ARGUMENT_KWARGS[arg.typ])
 
-    def _add_variables(self, objs: Dict[str, Any]) -> None:
+    def _required_actions(self, objs: _ModuleObjects, parser: argparse.ArgumentParser) -> List[Action]:
         """
-        Add custom variables to global
+        Get the actions whose arguments are required by the command line
+
+        They are the actions specified by `--tool` (or the default actions) and their dependences,
+        all actions are required by `--help`, and no action is required by `--version` or `--list`
         """
-        for k, obj in objs.items():
-            if not inspect.isfunction(obj):
-                continue
+        module_actions = {obj.name: obj for obj in objs.actions}
 
-            if obj.__name__ != 'build_script_variables':
+        # parse the basic arguments only
+        known_args, _ = parser.parse_known_args()
+
+        if known_args.help:
+            return list(module_actions.values())
+
+        if known_args.version or known_args.list:
+            return []
+
+        need_run: List[str] = known_args.tool.copy()
+        if len(need_run) == 0:
+            need_run = [k for k, act in module_actions.items() if act.default]
+
+        # walk the dependences, include the default actions (e.g. `build` -> `ninja`)
+        all_actions = {**self.actions, **module_actions}
+        visited = set()
+        while len(need_run) > 0:
+            act_name = need_run.pop()
+            if act_name in visited or act_name not in all_actions:
                 continue
 
-            self.variables.update(obj())
+            visited.add(act_name)
+            need_run += all_actions[act_name].deps
+
+        return [act for k, act in module_actions.items() if k in visited]
 
-    def _add_action_arguments(self, objs: Dict[str, Any], parser: argparse.ArgumentParser) -> None:
+    @staticmethod
+    def _load_objects(self_module: ModuleType) -> _ModuleObjects:
         """
-        Add argument for actions
+        Classify the actions, options and variables of the module in one pass
         """
-        for k, obj in objs.items():
-            if not isinstance(obj, Action):
-                continue
+        objs = _ModuleObjects([], [], [])
 
-            p = parser.add_argument_group(title=f'{obj.name} options')
+        # sorted by name, keep the same order as `inspect.getmembers`
+        for obj_key, obj in sorted(vars(self_module).items()):
+            if isinstance(obj, Action):
+                objs.actions.append(obj)
+            elif isinstance(obj, _OptionsDict):
+                objs.options.append(obj)
+            elif isinstance(obj, _VariablesDict):
+                objs.variables.append(obj)
 
-            for arg in obj.additional_args:
-                opt_name = f'--{obj.name}-{arg.name}'.replace('_', '-')
-
-                if arg.typ == ActionArgumentType.APPEND_LIST:
-                    # append to the list, like --arg va1 val2 ...
-                    p.add_argument(opt_name, type=str, default=[],
-                                   action="extend", nargs="+", help=arg.descript)
-                elif arg.typ == ActionArgumentType.OPTION:
-                    # store true
-                    p.add_argument(opt_name, default=False,
-                                   action='store_true', help=arg.descript)
-                elif arg.typ == ActionArgumentType.VALUE:
-                    # just a value
-                    p.add_argument(opt_name, type=str, default='',
-                                   help=arg.descript)
-                else:
-                    raise RuntimeWarning(f'Unknown type `{arg.typ}` for argument `{arg.name}`')
+        return objs
 
     @staticmethod
     def _dict_hash(dict: Dict[str, str], length: int = 1) -> str:
         """
         (protected) Get the string hash
         """
-        string = ''
+        hasher = hashlib.shake_128()
         for k, v in dict.items():
-            string += f'{k}={v},'
+            hasher.update(k.encode('utf-8'))
+            hasher.update(b'=')
+            hasher.update(v.encode('utf-8'))
+            hasher.update(b',')
 
-        return hashlib.shake_128(string.encode('utf-8')).hexdigest(length)
+        return hasher.hexdigest(length)
 
     @staticmethod
     def _parse_options(var_table: Dict[str, UserOption], args: List[str]) -> Dict[str, str]:
@@ -533,17 +643,10 @@ class BuildScript:
         result = {}
 
         for var_expr in args:
-            var_cont = var_expr.split('=')
-
-            # parse the input
-            if len(var_cont) == 1:
-                var_name = var_cont[0]
+            # parse the input, everything after the first `=` is the value
+            var_name, sep, var_value = var_expr.partition('=')
+            if not sep:
                 var_value = '1'
-            elif len(var_cont) == 2:
-                var_name = var_cont[0]
-                var_value = var_cont[1]
-            else:
-                raise BuildScriptException(f'Cannot parse option `{var_expr}`')
 
             # check the name, makesure the variable was defined
             if var_name not in var_table:
@@ -555,7 +658,7 @@ class BuildScript:
             if not filter_res:
                 raise BuildScriptException(f'{var_name} = `{var_value}` is invaild')
 
-            result.update({var_name: var_value})
+            result[var_name] = var_value
 
         return result
 
@@ -564,6 +667,9 @@ class BuildScript:
         """
         Add the basic arguments
         """
+        parser.add_argument('-h', '--help', default=False,
+                            action='store_true', help='show this help message and exit')
+
         parser.add_argument('-V', '--version', default=False,
                             action='store_true', help='print version info and exit')
 
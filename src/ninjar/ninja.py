@@ -8,18 +8,51 @@ Ninja generator helper
 This module provides the abstraction for ninja build scripts
 """
 
+from __future__ import annotations
+
 import glob
 import io
+import itertools
 import os
+import re
+import sys
+import threading
 import time
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
+from functools import partial
 from types import TracebackType
-from typing import Dict, Generator, List, Optional, Self, Union, final
-
-from .expr import global_eval_expr, global_eval_path
+from typing import (
+    Callable,
+    Dict,
+    FrozenSet,
+    Generator,
+    List,
+    Optional,
+    Self,
+    Tuple,
+    Union,
+    cast,
+    final,
+)
+
+from .expr import cached_global_eval_expr, global_eval_path
 from .shell import join_command
 
+# build item: rule, output, inputs, dynamic dependencies, implicit dependencies
+_BuildItem = Tuple[str, str, Tuple[str, ...], Tuple[str, ...], Tuple[str, ...]]
+
+# the last line of the file header
+_HEADER_END = b'# </autogen>\n'
+
+# templates of the rule statement
+_RULE_TEMPLATE = b'rule %b\n    command = %b\n'
+_RULE_DESCRIPTION_TEMPLATE = b'    description = %b\n'
+_RULE_DEPFILE_TEMPLATE = b'    depfile = %b\n'
+
+# type names of the extension names, see `_type_name`
+_TYPE_NAMES: Dict[str, str] = {}
+
 
 class QueryTypeError(RuntimeError):
     """
@@ -34,27 +67,40 @@ class NinjaGenerator:
     """
     Generate build.ninja
     """
-    # file handler
-    file_handler: io.TextIOWrapper
+    # output file path
+    file_path: str
+
+    # file header, with the generated time
+    header: bytes
+
+    # content buffer, it will be written to the file in `__exit__`
+    content_buf: bytearray
 
     # build item
-    build_item: List[str]
+    build_item: List[_BuildItem]
 
     # default item
     default_item: List[str]
 
+    # per-thread records of `parallel_collect`
+    parallel_local: threading.local
+
     def __init__(self, file: str = './build.ninja') -> None:
+        """
+        Create the generator, the output is compressed if `file` ends with `.gz` or `.zst`
+        """
         self.build_item = []
         self.default_item = []
-        self.file_handler = open(file, 'w', encoding='utf-8')
+        self.parallel_local = threading.local()
+        self.file_path = file
+        self.content_buf = bytearray()
         # write the date
         cur_time = time.strftime('%Y-%m-%d %H:%M:%S (%Z)', time.localtime())
-        self.file_handler.writelines([
+        self.header = ''.join([
             '# <autogen>\n',
             '# This file was auto generated, DO NOT edit it by manual\n',
             f'# Generated at {cur_time}\n',
-            '# </autogen>\n',
-        ])
+        ]).encode('utf-8') + _HEADER_END
 
     def __enter__(self) -> Self:
         return self
@@ -65,25 +111,43 @@ class NinjaGenerator:
         exc_val: Optional[BaseException],
         exc_tb: Optional[TracebackType],
     ) -> None:
-        # write the build items
-        for line in self.build_item:
-            self.file_handler.write(line)
-            self.file_handler.write('\n')
+        # the script failed, keep the old file instead of writing a partial one
+        if exc_type is not None:
+            return
 
         # default targets
         defaults = ' '.join(self.default_item)
         default_stat = f'default {defaults}'
 
-        # write the default target
-        self.file_handler.writelines([
-            f'# {len(self.build_item)} build statements were generated\n',
-            '# default target:\n',
+        # format the build items, and write them with the default target at once
+        build_lines = '\n'.join(NinjaGenerator._format_build(*item) for item in self.build_item)
+        trailer = [
+            f'# {len(self.build_item)} build statements were generated',
+            '# default target:',
             default_stat,
-            '\n',
-        ])
-
-        # close the file
-        self.file_handler.close()
+        ]
+        if len(self.build_item) > 0:
+            self.content_buf += build_lines.encode('utf-8')
+            self.content_buf += b'\n'
+        self.content_buf += '\n'.join(trailer).encode('utf-8')
+        self.content_buf += b'\n'
+
+        # keep the file (and its mtime) if the content was not changed, the header is ignored
+        old_body = _read_output_body(self.file_path)
+        if old_body is not None and self.content_buf == old_body:
+            return
+
+        # write a temporary file and replace the old one
+        dir_name, base_name = os.path.split(self.file_path)
+        temp_path = os.path.join(dir_name, f'.tmp.{base_name}')
+        try:
+            with _open_output(temp_path) as f:
+                f.write(self.header)
+                f.write(self.content_buf)
+            os.replace(temp_path, self.file_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
 
     def add_rule(self, name: str, command: str, description: str = '', dep_file: str = '') -> None:
         """
@@ -95,12 +159,16 @@ class NinjaGenerator:
             description (str, optional): rule description
             dep_file (str, optional): dependence files
         """
-        self.file_handler.write(f'rule {name}\n')
-        self.file_handler.write(f'    command = {command}\n')
+        records = self._parallel_records()
+        if records is not None:
+            records.append(partial(self.add_rule, name, command, description, dep_file))
+            return
+
+        self.content_buf += _RULE_TEMPLATE % (name.encode('utf-8'), command.encode('utf-8'))
         if len(description) > 0:
-            self.file_handler.write(f'    description = {description}\n')
+            self.content_buf += _RULE_DESCRIPTION_TEMPLATE % description.encode('utf-8')
         if len(dep_file) > 0:
-            self.file_handler.write(f'    depfile = {dep_file}\n')
+            self.content_buf += _RULE_DEPFILE_TEMPLATE % dep_file.encode('utf-8')
 
     def add_build(
         self,
@@ -118,10 +186,27 @@ class NinjaGenerator:
             out (str): output files
             inp (List[str]): input files
         """
-        stat = f'build {out}: {rule}'
+        # the statement is formatted in `__exit__`
+        item = (rule, out, tuple(inp), tuple(dyn_deps), tuple(imp_deps))
 
-        # input items
-        stat += ' ' + ' '.join(inp)
+        records = self._parallel_records()
+        if records is not None:
+            records.append(partial(self.build_item.append, item))
+        else:
+            self.build_item.append(item)
+
+    @staticmethod
+    def _format_build(
+        rule: str,
+        out: str,
+        inp: Tuple[str, ...],
+        dyn_deps: Tuple[str, ...],
+        imp_deps: Tuple[str, ...]
+    ) -> str:
+        """
+        (private) Format the build statement
+        """
+        stat = f'build {out}: {rule} ' + ' '.join(inp)
 
         if len(imp_deps) > 0:
             stat += ' | ' + ' '.join(imp_deps)
@@ -129,17 +214,62 @@ class NinjaGenerator:
         if len(dyn_deps) > 0:
             stat += '|| ' + ' '.join(dyn_deps)
 
-        self.build_item.append(stat)
+        return stat
 
     def add_defaults(self, file: Union[str, List[str]]) -> None:
         """
         Add the default target
         """
+        records = self._parallel_records()
+        if records is not None:
+            records.append(partial(self.add_defaults, file if isinstance(file, str) else list(file)))
+            return
+
         if isinstance(file, str):
             self.default_item.append(file)
         else:
             self.default_item += file
 
+    def parallel_collect(self, queries: List[Query], max_workers: Optional[int] = None) -> List[List[str]]:
+        """
+        Collect the queries in the worker threads, and return the files of each query
+
+        The calls of `add_rule`, `add_build` and `add_defaults` in the workers are recorded,
+        and replayed in the order of `queries` after all queries were collected.
+        So the output is the same as collecting the queries one by one if the stages
+
+        * write the file only by these methods (and `Stage.apply`), and
+        * do not depend on the order of `generate_rule` and `generate_build`:
+          in the workers, `generate_build` runs before the rule was generated
+        """
+        # imported here, it is not needed by the most build scripts
+        from concurrent.futures import ThreadPoolExecutor
+
+        def worker(query: Query) -> Tuple[List[str], List[Callable[[], None]]]:
+            records: List[Callable[[], None]] = []
+            self.parallel_local.records = records
+            try:
+                return query.collect_files(), records
+            finally:
+                del self.parallel_local.records
+
+        with ThreadPoolExecutor(max_workers) as pool:
+            results = list(pool.map(worker, queries))
+
+        # replay the records
+        for _, records in results:
+            for record in records:
+                record()
+
+        return [files for files, _ in results]
+
+    def _parallel_records(self) -> Optional[List[Callable[[], None]]]:
+        """
+        (private) Get the recorded calls of the current `parallel_collect` worker
+        """
+        records: Optional[List[Callable[[], None]]] = getattr(self.parallel_local, 'records', None)
+        return records
+
 
 class Stage(ABC):
     """
@@ -175,24 +305,31 @@ class Stage(ABC):
         return self.name
 
     def apply(self, input: List[str]) -> str:
+        # in `parallel_collect`, the rule is generated when the records are replayed
+        records = self.ninja._parallel_records()
+        if records is not None:
+            records.append(self.ensure_rule)
+        else:
+            self.ensure_rule()
+
+        return self.generate_build(input)
+
+    def ensure_rule(self) -> None:
+        """
+        Generate the ninja rule statement if it was not generated
+        """
         if not self.generated_rule:
             self.generate_rule()
             self.generated_rule = True
 
-        return self.generate_build(input)
-
     def _add_option(self, opt: Union[List[str], str]) -> None:
         """
         (protected) Add options with global_eval_expr
         """
-        def inner_fn(opt_item: str) -> None:
-            self.cmd.append(global_eval_expr(opt_item))
-
         if isinstance(opt, str):
-            inner_fn(opt)
+            self.cmd.append(cached_global_eval_expr(opt))
         else:
-            for opt_item in opt:
-                inner_fn(opt_item)
+            self.cmd.extend([cached_global_eval_expr(opt_item) for opt_item in opt])
 
     def _get_command(self) -> str:
         """
@@ -252,7 +389,7 @@ class UnitStage(Stage):
         return input[0]
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Element:
     """
     Element is the input and output for building rules
@@ -292,23 +429,24 @@ class Query:
         `UnitStage` class provides an identity element.
         `self.apply(unit_stage)` will returns the same output as the input
         """
-        def inner_fn() -> Generator[Element, None, None]:
+        def single_fn(rule_item: Stage) -> Generator[Element, None, None]:
+            # the common case, only one rule
+            inp_type = Query._input_types(rule_item)
+            apply_rule = Query._apply_rule
+
             for item in self.it:
-                for rule_item in rule:
-                    inp_type = rule_item.input_type()
-                    # check the type
-                    if ':any' not in inp_type and item.type_name not in inp_type:
-                        raise QueryTypeError(f'`apply` type error: input `{item.type_name}` -> rule `{inp_type}`')
+                yield apply_rule(rule_item, inp_type, item)
 
-                    # apply the rule
-                    out_file = rule_item.apply(item.element)
+        def inner_fn() -> Generator[Element, None, None]:
+            checks = [(rule_item, Query._input_types(rule_item)) for rule_item in rule]
+            apply_rule = Query._apply_rule
 
-                    # return the result
-                    ext_name = Query._extension_name(out_file)
-                    if len(ext_name) == 0:
-                        raise QueryTypeError(f'`apply` type error: unknown type name for file `{out_file}`')
+            for item in self.it:
+                for rule_item, inp_type in checks:
+                    yield apply_rule(rule_item, inp_type, item)
 
-                    yield Element([out_file], f'type_{ext_name}')
+        if len(rule) == 1:
+            return Query(single_fn(rule[0]))
 
         return Query(inner_fn())
 
@@ -327,11 +465,10 @@ class Query:
                     raise QueryTypeError(f'`fold` type error: `{item.type_name}` fold to `{inp_type}`')
 
                 # append the items
-                for item_inner in item.element:
-                    lst.append(item_inner)
+                lst.extend(item.element)
 
             # return the result
-            yield Element(lst, f'{inp_type}')
+            yield Element(lst, inp_type)
 
         return Query(inner_fn())
 
@@ -343,18 +480,12 @@ class Query:
             result: Dict[str, List[str]] = {}
 
             for item in self.it:
-                inp_type = item.type_name
-
-                if inp_type not in result:
-                    result[inp_type] = []
-
                 # append the items
-                for item_inner in item.element:
-                    result[inp_type].append(item_inner)
+                result.setdefault(item.type_name, []).extend(item.element)
 
             # return the result
             for typ, result_item in result.items():
-                yield Element(result_item, f'{typ}')
+                yield Element(result_item, typ)
 
         return Query(inner_fn())
 
@@ -362,13 +493,21 @@ class Query:
         """
         Collect the result to a list and evaluates the Query
         """
+        return list(itertools.chain.from_iterable(val.element for val in self.it))
 
-        lst = []
+    def collect_single(self) -> List[str]:
+        """
+        Collect the result like `collect_files`, each element must have exactly one file
+
+        e.g. the result of `select` or `apply`
+        """
+        result = []
         for val in self.it:
-            for item in val.element:
-                lst.append(item)
+            if len(val.element) != 1:
+                raise QueryTypeError(f'`collect_single` type error: `{val.element}` is not a single file')
+            result.append(val.element[0])
 
-        return lst
+        return result
 
     def concat(self, other: Self) -> "Query":
         """
@@ -410,10 +549,13 @@ class Query:
         return Query(inner_fn())
 
     @staticmethod
-    def from_glob(glob_filter: Union[List[str], str], exclude: List[str] = []) -> "Query":
+    def from_glob(glob_filter: Union[List[str], str], exclude: Optional[List[str]] = None) -> "Query":
         """
         Get the data view by glob expression
         """
+        # match all excluded sub-strings in one scan
+        exclude_pattern = re.compile('|'.join(map(re.escape, exclude))) if exclude else None
+
         def inner_fn() -> Generator[Element, None, None]:
             if isinstance(glob_filter, str):
                 filters = [glob_filter]
@@ -424,17 +566,144 @@ class Query:
                 filter_eval = global_eval_path(filter_item)
                 for file in glob.iglob(filter_eval):
                     # filter the files
-                    res = [i for i in exclude if i in file]
-                    if len(res) == 0:
+                    if exclude_pattern is None or exclude_pattern.search(file) is None:
                         ext_name = Query._extension_name(file)
                         # Add files that are not on the exclusion list
-                        yield Element([file], f'type_{ext_name}')
+                        yield Element([file], _type_name(ext_name))
 
         return Query(inner_fn())
 
+    @staticmethod
+    def _input_types(rule: Stage) -> Optional[FrozenSet[str]]:
+        """
+        (private) Get the acceptable types of the rule, `None` means any types
+        """
+        types = frozenset(map(sys.intern, rule.input_type()))
+        return None if ':any' in types else types
+
+    @staticmethod
+    def _apply_rule(rule: Stage, inp_type: Optional[FrozenSet[str]], item: Element) -> Element:
+        """
+        (private) Apply the rule to an element
+        """
+        # the identity, returns the same element (the input length is still checked)
+        if isinstance(rule, UnitStage):
+            rule.generate_build(item.element)
+            return item
+
+        # check the type
+        if inp_type is not None and item.type_name not in inp_type:
+            raise QueryTypeError(f'`apply` type error: input `{item.type_name}` -> rule `{rule.input_type()}`')
+
+        # apply the rule
+        out_file = rule.apply(item.element)
+
+        # return the result
+        ext_name = Query._extension_name(out_file)
+        if len(ext_name) == 0:
+            raise QueryTypeError(f'`apply` type error: unknown type name for file `{out_file}`')
+
+        return Element([out_file], _type_name(ext_name))
+
     @staticmethod
     def _extension_name(file: str) -> str:
         """
         Get the extension name without the `dot`, e.g. `123.c` -> `c`
         """
-        return os.path.splitext(file)[1][1:].lower()
+        return extension_name(file)[1:].lower()
+
+
+def extension_name(file: str) -> str:
+    """
+    Get the extension name with the `dot`, e.g. `src/123.c` -> `.c`
+
+    Same as `os.path.splitext`, the leading dots of the file name are not the extension,
+    and both `/` and `\\` are the path separators.
+    """
+    dot_pos = file.rfind('.')
+    sep_pos = max(file.rfind('/'), file.rfind('\\'))
+    if dot_pos <= sep_pos:
+        return ''
+
+    # skip the leading dots, e.g. `.bashrc` or `..foo`
+    name_pos = sep_pos + 1
+    while name_pos < dot_pos and file[name_pos] == '.':
+        name_pos += 1
+
+    return file[dot_pos:] if name_pos < dot_pos else ''
+
+
+def _type_name(ext_name: str) -> str:
+    """
+    (private) Get the interned type name of the extension name, e.g. `c` -> `type_c`
+    """
+    type_name = _TYPE_NAMES.get(ext_name)
+    if type_name is None:
+        type_name = _TYPE_NAMES[ext_name] = sys.intern(f'type_{ext_name}')
+
+    return type_name
+
+
+def _read_output_body(file: str) -> Optional[bytes]:
+    """
+    (private) Read the content of the last output without the header
+
+    Return `None` if it does not exist or cannot be read.
+    """
+    try:
+        content = _read_output(file)
+    except (OSError, EOFError):
+        return None
+
+    if content is None:
+        return None
+
+    # the header ends with the `</autogen>` line
+    header_end = content.find(_HEADER_END)
+    if header_end < 0:
+        return None
+
+    return content[header_end + len(_HEADER_END):]
+
+
+def _read_output(file: str) -> Optional[bytes]:
+    """
+    (private) Read the output file, decompress it by the file suffix
+    """
+    if file.endswith('.gz'):
+        import gzip
+        with gzip.open(file, 'rb') as f:
+            return f.read()
+
+    if file.endswith('.zst'):
+        try:
+            import zstandard  # type: ignore[import-not-found, unused-ignore]
+        except ImportError:
+            return None
+        try:
+            with open(file, 'rb') as f:
+                return bytes(zstandard.ZstdDecompressor().stream_reader(f).read())
+        except zstandard.ZstdError:
+            return None
+
+    with open(file, 'rb') as f:
+        return f.read()
+
+
+def _open_output(file: str) -> io.BufferedIOBase:
+    """
+    (private) Open the output file, compress it by the file suffix
+    """
+    # the compressors are imported only if they are used
+    if file.endswith('.gz'):
+        import gzip
+        return gzip.open(file, 'wb', compresslevel=1)
+
+    if file.endswith('.zst'):
+        try:
+            import zstandard  # type: ignore[import-not-found, unused-ignore]
+        except ImportError:
+            raise RuntimeError('The `zstandard` package is required to write `.zst` files')
+        return cast(io.BufferedIOBase, zstandard.ZstdCompressor(level=3).stream_writer(open(file, 'wb')))
+
+    return open(file, 'wb')
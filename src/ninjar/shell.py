@@ -7,10 +7,14 @@ Shell execute helper
 """
 
 
+from __future__ import annotations
+
+import os
 import subprocess
-from typing import List, Union
+from contextlib import contextmanager
+from typing import IO, Iterator, List, Tuple, Union
 
-from .expr import global_eval_path, global_eval_expr
+from .expr import global_eval_expr, global_eval_path
 from .writeln import LogLevel, log_out
 
 
@@ -26,20 +30,18 @@ class ShellError(RuntimeError):
 def execute(cmd: Union[str, List[str]], shell: bool = False) -> None:
     """
     Execute the command
-    """
-    if isinstance(cmd, str):
-        cmd_str = join_command([cmd])
-    else:
-        cmd_str = join_command(cmd)
 
+    Without the shell, each item of a list command is one argument on POSIX,
+    the variables in it are not split by spaces (see `_eval_command`)
+    """
     # replace variables
-    cmd_eval = global_eval_expr(cmd_str)
-    log_out(LogLevel.DEBUG, f'> run `{cmd_eval}`')
+    cmd_eval, cmd_str = _eval_command(cmd, shell)
+    log_out(LogLevel.DEBUG, f'> run `{cmd_str}`')
 
     try:
         subprocess.run(cmd_eval, check=True, shell=shell)
     except subprocess.CalledProcessError:
-        raise ShellError(f'command `{cmd_eval}` exit code is not 0')
+        raise ShellError(f'command `{cmd_str}` exit code is not 0')
 
 
 def execute_with_stdout(
@@ -49,37 +51,108 @@ def execute_with_stdout(
 ) -> str:
     """
     Execute the command and return the stdout
+
+    The list command is handled like `execute`
     """
-    if isinstance(cmd, str):
-        cmd_str = join_command([cmd])
-    else:
-        cmd_str = join_command(cmd)
+    return execute_capture_bytes(cmd, shell).decode(encoding).rstrip()
+
 
+def execute_capture_bytes(cmd: Union[str, List[str]], shell: bool = False) -> bytes:
+    """
+    Execute the command and return the stdout without decoding
+    """
     # replace variables
-    cmd_eval = global_eval_expr(cmd_str)
-    log_out(LogLevel.DEBUG, f'> run `{cmd_eval}`')
+    cmd_eval, cmd_str = _eval_command(cmd, shell)
+    log_out(LogLevel.DEBUG, f'> run `{cmd_str}`')
 
     try:
         cmd_out = subprocess.run(cmd_eval, check=True, capture_output=True, shell=shell)
-        return cmd_out.stdout.decode(encoding).rstrip()
+        return cmd_out.stdout.rstrip()
     except subprocess.CalledProcessError:
-        raise ShellError(f'command `{cmd_eval}` exit code is not 0')
+        raise ShellError(f'command `{cmd_str}` exit code is not 0')
+
+
+@contextmanager
+def execute_with_pipe(
+    cmd: Union[str, List[str]],
+    encoding: str = 'utf-8',
+    shell: bool = False
+) -> Iterator[IO[str]]:
+    """
+    Execute the command and provide the stdout as a stream
+    """
+    # replace variables
+    cmd_eval, cmd_str = _eval_command(cmd, shell)
+    log_out(LogLevel.DEBUG, f'> run `{cmd_str}`')
+
+    with subprocess.Popen(cmd_eval, stdout=subprocess.PIPE, encoding=encoding, shell=shell) as proc:
+        assert proc.stdout is not None
+        try:
+            yield proc.stdout
+        except Exception as e:
+            # the output of a failed command may be broken, report the command error instead
+            proc.communicate()
+            if proc.returncode != 0:
+                raise ShellError(f'command `{cmd_str}` exit code is not 0') from e
+            raise
+
+    if proc.returncode != 0:
+        raise ShellError(f'command `{cmd_str}` exit code is not 0')
 
 
 def save_content(path: str, content: str, encoding: str = 'utf-8') -> str:
     """
     Save the string content
     """
+    return save_bytes(path, content.encode(encoding))
+
+
+def save_bytes(path: str, content: bytes) -> str:
+    """
+    Save the bytes content
+    """
     path_val = global_eval_path(path)
-    str_byte = content.encode(encoding)
     with open(path_val, 'wb') as f:
-        f.write(str_byte)
+        f.write(content)
 
     return path_val
 
 
+def _eval_command(cmd: Union[str, List[str]], shell: bool) -> Tuple[Union[str, List[str]], str]:
+    """
+    (private) Replace the variables in the command, return the command and its display string
+
+    Without the shell, a list command is passed as the argument list directly on POSIX,
+    so the program is executed without quoting and re-parsing the arguments.
+    On Windows, the joined command line is passed as before,
+    so a variable with spaces (e.g. `$cflags` = `-O2 -g`) is still split into multiple arguments.
+    """
+    if isinstance(cmd, str):
+        cmd_eval = global_eval_expr(join_command([cmd]))
+        return cmd_eval, cmd_eval
+
+    if shell or os.name == 'nt':
+        cmd_eval = global_eval_expr(join_command(cmd))
+        return cmd_eval, cmd_eval
+
+    args = [global_eval_expr(arg) for arg in cmd]
+    return args, join_command(args)
+
+
 def join_command(args: List[str]) -> str:
     """
     Join the space into `args`
     """
-    return ' '.join(map(lambda s: f'"{s}"' if s.find(' ') != -1 else s, args))
+    # a single command, e.g. `execute('ninja')`
+    if len(args) == 1:
+        arg = args[0]
+        return f'"{arg}"' if ' ' in arg and not _is_quoted(arg) else arg
+
+    return ' '.join(f'"{arg}"' if ' ' in arg and not _is_quoted(arg) else arg for arg in args)
+
+
+def _is_quoted(arg: str) -> bool:
+    """
+    (private) Check the argument was quoted
+    """
+    return len(arg) >= 2 and arg[0] == '"' and arg[-1] == '"'
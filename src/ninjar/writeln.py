@@ -6,6 +6,9 @@
 Colorful write_ln
 """
 
+from __future__ import annotations
+
+import sys
 from enum import Enum
 
 import colorama
@@ -13,6 +16,9 @@ from colorama import Fore
 
 global_level: int = 0
 
+# write the color codes, colorama strips them if the stdout is not a terminal
+_USE_COLOR: bool = True
+
 
 class LogLevel(Enum):
     DEBUG = 0
@@ -36,11 +42,38 @@ class Color(Enum):
     LightWhite = 'lightwhite'
 
 
+# color of each log level
+_LEVEL_COLOR = {
+    LogLevel.DEBUG: Color.Gray,
+    LogLevel.INFO: Color.RESET,
+    LogLevel.MESSAGE: Color.LightWhite,
+    LogLevel.WARN: Color.Yellow,
+    LogLevel.ERROR: Color.Red,
+    LogLevel.FATAL: Color.Red,
+}
+
+# terminal color codes
+_COLOR_FORE = {
+    Color.RESET: Fore.RESET,
+    Color.Red: Fore.RED,
+    Color.Green: Fore.GREEN,
+    Color.White: Fore.WHITE,
+    Color.Yellow: Fore.YELLOW,
+    Color.Cyan: Fore.CYAN,
+    Color.Gray: Fore.LIGHTBLACK_EX,
+    Color.LightBlue: Fore.LIGHTBLUE_EX,
+    Color.LightGreen: Fore.LIGHTGREEN_EX,
+    Color.LightWhite: Fore.LIGHTWHITE_EX,
+}
+
+
 def init() -> None:
     """
     Initialize colorful write_ln
     """
+    global _USE_COLOR
     colorama.init(autoreset=True)
+    _USE_COLOR = sys.stdout.isatty()
 
 
 def set_log_level(lev: LogLevel) -> None:
@@ -59,37 +92,15 @@ def log_out(lev: LogLevel, content: str) -> None:
     if lev.value < global_level:
         return
 
-    color = {
-        LogLevel.DEBUG: Color.Gray,
-        LogLevel.INFO: Color.RESET,
-        LogLevel.MESSAGE: Color.LightWhite,
-        LogLevel.WARN: Color.Yellow,
-        LogLevel.ERROR: Color.Red,
-        LogLevel.FATAL: Color.Red,
-
-    }
-
-    colorful_print(color[lev], content)
+    colorful_print(_LEVEL_COLOR[lev], content)
 
 
 def colorful_print(color_val: Color, content: str) -> None:
     """
     Print content with color
     """
-    color = {
-        Color.RESET: Fore.RESET,
-        Color.Red: Fore.RED,
-        Color.Green: Fore.GREEN,
-        Color.White: Fore.WHITE,
-        Color.Yellow: Fore.YELLOW,
-        Color.Cyan: Fore.CYAN,
-        Color.Gray: Fore.LIGHTBLACK_EX,
-        Color.LightBlue: Fore.LIGHTBLUE_EX,
-        Color.LightGreen: Fore.LIGHTGREEN_EX,
-        Color.LightWhite: Fore.LIGHTWHITE_EX,
-    }
     # print the content
-    if color_val in color:
-        print(color[color_val] + content + Fore.RESET)
+    if _USE_COLOR and color_val in _COLOR_FORE:
+        print(_COLOR_FORE[color_val] + content + Fore.RESET)
     else:
         print(content)